@@ -2,11 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import collections
-import json
-import signal
+import math
 import sys
+import threading
 import time
-import re
+from bisect import bisect_left, insort
 import paho.mqtt.client as mqtt
 
 # --------------------------------------------------------------------------- #
@@ -20,49 +20,152 @@ TOPIC_FILTER_NEW = "Filter/new"  # Topic pour créer un nouveau filtre
 TOPIC_FILTER_DELETE = "Filter/delete"  # Topic pour supprimer un filtre
 INITIAL_FILTER_TOPIC = "simulateur/A/value"  # Topic initial à filtrer
 TOPIC_FILTER_INFO = "Filter/infos"  # Topic pour afficher les dernières infos
+
+# Abonnements faits une fois pour toutes à la connexion : les jokers couvrent les topics
+# source et paramètres de tous les filtres créés sur simulateur/X/value
+BASE_SUBSCRIPTIONS = [
+    (TOPIC_FILTER_NEW, 0),  # Topic de création
+    (TOPIC_FILTER_DELETE, 0),  # Topic de suppression
+    ("simulateur/+/value", 0),  # Topics de valeurs simulées par le script MQTT_Simulateur.py
+    ("simulateur/+/+/mode", 0),  # Mode des filtres : simulateur/X/value_filtered_X_N/mode
+    ("simulateur/+/+/window", 0),  # Fenêtre des filtres : simulateur/X/value_filtered_X_N/window
+]
 DEFAULT_MODE = 1
 # 1 : moyenne glissante
 # 2 : médiane glissante
 # 3 : max glissant
 # 4 : min glissant
 DEFAULT_WINDOW_SIZE = 5 # x dernières valeurs (filtre temps réel)
+MEDIAN_SORTED_MIN_WINDOW = 5  # médiane : copie triée tenue à jour (bisect) à partir de cette taille, tri complet en dessous
+RESYNC_FACTOR = 1024  # recalcul exact de la somme glissante toutes les window_size * N valeurs
+INFO_PUBLISH_INTERVAL = 1.0  # délai minimal (s) entre deux publications sur TOPIC_FILTER_INFO
+RECONNECT_DELAY = 1.0  # attente (s) avant chaque tentative de reconnexion au broker
+DEBUG = False  # True : signaler aussi chaque valeur invalide reçue
+
+# Paramètres initiaux publiés à la création de chaque filtre (encodés une fois pour toutes)
+_DEFAULT_MODE_B = str(DEFAULT_MODE).encode()
+_DEFAULT_WINDOW_B = str(DEFAULT_WINDOW_SIZE).encode()
 
 class Filter:
+    __slots__ = ('source_topic', 'filter_name', 'filtered_topic', 'mode_topic', 'window_topic',
+                 'mode', 'window_size', '_buf', '_head', '_count', '_sum', '_sorted', '_ops', '_extremum',
+                 'process_value')
+
     def __init__(self, source_topic, filter_name, window_size=DEFAULT_WINDOW_SIZE, mode=DEFAULT_MODE):
         self.source_topic = source_topic
         self.filter_name = filter_name  # Ex: "A_1", "A_2", etc.
         self.filtered_topic = f"{source_topic}_filtered_{filter_name}"
         self.mode_topic = f"{source_topic}_filtered_{filter_name}/mode"
         self.window_topic = f"{source_topic}_filtered_{filter_name}/window"
-        self.mode = mode
         self.window_size = window_size
-        self.window = collections.deque(maxlen=window_size)
-
-    def process_value(self, value):
-        self.window.append(value)
-
-        if self.mode == 1:  # moyenne
-            filtered = sum(self.window) / len(self.window)
-
-        if self.mode == 2:  # median
-            sorted_w = sorted(self.window)
-            mid_i = len(sorted_w) // 2
-            filtered = (sorted_w[mid_i - 1] + sorted_w[mid_i]) / 2.0 if len(sorted_w) % 2 == 0 else sorted_w[mid_i]
-
-        if self.mode == 3:  # max
-            filtered = max(self.window)
-
-        if self.mode == 4:  # main
-            filtered = min(self.window)
-
-        return filtered
+        self._buf = [0.0] * window_size  # buffer circulaire préalloué
+        self._head = 0  # prochaine case à écrire (= plus ancienne valeur si plein)
+        self._count = 0
+        self._sum = 0.0  # somme glissante de la fenêtre, tenue seulement en mode moyenne
+        self._sorted = None  # copie triée de la fenêtre, tenue seulement en mode médiane (grandes fenêtres)
+        self._ops = 0
+        self._extremum = max  # max ou min (modes 3 et 4)
+        self.update_mode(mode)
+
+    # Traitement d'une valeur, un par mode : chacun n'entretient que l'état dont sa
+    # statistique a besoin. process_value est lié à l'un d'eux par update_mode.
+    # Chemin chaud : chaque attribut n'est lu qu'une fois (variables locales)
+
+    def _process_mean(self, value):
+        buf = self._buf
+        head = self._head
+        size = self.window_size
+        total = self._sum
+
+        # La valeur la plus ancienne sort de la fenêtre : on la retire de la somme
+        if self._count == size:
+            total -= buf[head]
+        else:
+            self._count += 1
+        buf[head] = value
+        head += 1
+        self._head = 0 if head == size else head
+        self._sum = total + value
+
+        # Recalcul exact périodique pour borner la dérive des arrondis
+        self._ops += 1
+        if self._ops >= size * RESYNC_FACTOR:
+            self._sum = math.fsum(buf[:self._count])
+            self._ops = 0
+
+        return self._sum / self._count
+
+    def _process_median(self, value):
+        buf = self._buf
+        head = self._head
+        size = self.window_size
+        sorted_w = self._sorted
+
+        # La valeur la plus ancienne sort de la fenêtre : on la retire de la copie triée
+        if self._count == size:
+            if sorted_w is not None:
+                del sorted_w[bisect_left(sorted_w, buf[head])]
+        else:
+            self._count += 1
+        buf[head] = value
+        head += 1
+        self._head = 0 if head == size else head
+        if sorted_w is None:
+            # Petite fenêtre : un tri complet coûte moins que bisect + del + insort
+            sorted_w = sorted(buf) if self._count == size else sorted(buf[:self._count])
+        else:
+            insort(sorted_w, value)
+
+        mid_i = len(sorted_w) // 2
+        return (sorted_w[mid_i - 1] + sorted_w[mid_i]) / 2.0 if len(sorted_w) % 2 == 0 else sorted_w[mid_i]
+
+    def _process_extremum(self, value):
+        # max()/min() en C directement sur le buffer : plus rapides qu'une copie triée tenue à jour
+        buf = self._buf
+        head = self._head
+        size = self.window_size
+        buf[head] = value
+        head += 1
+        self._head = 0 if head == size else head
+        if self._count == size:
+            return self._extremum(buf)
+        self._count += 1
+        return self._extremum(buf[:self._count])
+
+    def update_mode(self, new_mode):
+        """Change de mode : le traitement est choisi ici une fois, pas à chaque valeur.
+
+        L'état propre au nouveau mode (somme glissante ou copie triée) est reconstruit
+        depuis le buffer, celui de l'ancien mode abandonné.
+        """
+        self.mode = new_mode
+        window = self._buf[:self._count]
+        self._sorted = None
+        if new_mode == 1:
+            self._sum = math.fsum(window)
+            self._ops = 0
+            self.process_value = self._process_mean
+        elif new_mode == 2:
+            if self.window_size >= MEDIAN_SORTED_MIN_WINDOW:
+                self._sorted = sorted(window)
+            self.process_value = self._process_median
+        else:
+            self._extremum = max if new_mode == 3 else min
+            self.process_value = self._process_extremum
 
     def update_window_size(self, new_size):
-        old_vals = list(self.window)
+        # Valeurs actuelles dans l'ordre chronologique
+        if self._count == self.window_size:
+            old_vals = self._buf[self._head:] + self._buf[:self._head]
+        else:
+            old_vals = self._buf[:self._count]
+        kept = old_vals[-new_size:]
+
         self.window_size = new_size
-        self.window = collections.deque(maxlen=new_size)
-        for v in old_vals[-new_size:]:
-            self.window.append(v)
+        self._buf = kept + [0.0] * (new_size - len(kept))
+        self._count = len(kept)
+        self._head = self._count % new_size
+        self.update_mode(self.mode)  # somme / copie triée recalculées sur la nouvelle fenêtre
 
     def delete_topics(self, client):
         """Supprime tous les topics du filtre en publiant des chaînes vides."""
@@ -71,17 +174,36 @@ class Filter:
             client.publish(topic, payload="", qos=1, retain=True)
 
 filters = {}  # key: filter_name (ex: "A_1"), value: instance Filter
+filters_by_source = {}  # key: topic source, value: liste des filtres de ce topic
+filters_by_param_topic = {}  # key: topic mode/window, value: instance Filter
 source_counters = {}  # key: topic source, value: compteur pour la nomenclature
 mode_names = ['none', 'moyenne', 'médiane', 'maximum', 'minimum']
 
 # Fonctions utilitaires
+def uncovered_topics(topics):
+    """Retourne les topics qui ne sont couverts par aucun abonnement de BASE_SUBSCRIPTIONS."""
+    return [topic for topic in topics
+            if not any(mqtt.topic_matches_sub(sub, topic) for sub, _ in BASE_SUBSCRIPTIONS)]
+
+_last_ts_s = 0
+_last_ts_str = ''
+
+def _now_hms():
+    """Horodatage HH:MM:SS, recalculé au plus une fois par seconde."""
+    global _last_ts_s, _last_ts_str
+    s = int(time.time())
+    if s != _last_ts_s:
+        _last_ts_s = s
+        _last_ts_str = time.strftime('%H:%M:%S', time.localtime(s))
+    return _last_ts_str
+
 def extract_variable_name(source_topic):
     """Extrait le nom de la variable depuis le topic source.
     Ex: 'simulateur/A/value' -> 'A'
     """
-    match = re.search(r'simulateur/([^/]+)/value', source_topic)
-    if match:
-        return match.group(1)
+    parts = source_topic.split('/')
+    if len(parts) >= 3 and parts[0] == 'simulateur' and parts[2].startswith('value'):
+        return parts[1]
     else:
         # Fallback: utiliser le topic complet sans les slashes
         return source_topic.replace('/', '_')
@@ -104,52 +226,60 @@ def generate_filter_name(source_topic):
         if proposed_name not in filters:
             return proposed_name
 
-def find_filter_by_param_topic(param_topic):
-    """Trouve le filtre correspondant à un topic de paramètre."""
-    for filter_name, filter_obj in filters.items():
-        if param_topic == filter_obj.mode_topic or param_topic == filter_obj.window_topic:
-            return filter_obj
-    return None
 
+# Arrêt sur SIGINT (Ctrl-C) : appelé à la sortie de la boucle réseau plutôt que depuis un
+# gestionnaire de signal, qui pourrait interrompre paho alors qu'il tient un de ses verrous
+_stop = threading.Event()
 
-# Gestion du signal SIGINT
-def graceful_shutdown(signum, frame):
+def graceful_shutdown():
     print("\nArrêt demandé – nettoyage…")
+    _stop.set()
     client.disconnect()
-    sys.exit(0)
 
-signal.signal(signal.SIGINT, graceful_shutdown)
-
-messages = []
 messages_max = 10
+messages = collections.deque(maxlen=messages_max)
+_info_pending = False  # messages pas encore publiés sur TOPIC_FILTER_INFO
+_last_info_pub = 0.0
 
-# Display infos sur TOPIC_FILTER_INFO
-def print_mqtt(message):
-    print(message)
-    messages.append(message)
-
-    while len(messages) > messages_max:
-        messages.pop(0)
-
-    last_X_messages = "\n".join(messages)
+def publish_infos():
+    """Publie les derniers messages sur TOPIC_FILTER_INFO."""
+    global _info_pending, _last_info_pub
+    _info_pending = False
+    _last_info_pub = time.monotonic()
 
     # ne garde que les 1000 derniers caractères
-    last_X_messages = last_X_messages[-10000:]
+    last_X_messages = "\n".join(messages)[-10000:]
 
     client.publish(TOPIC_FILTER_INFO, last_X_messages, qos=0, retain=True)
 
+def flush_infos_if_due():
+    """Publie les messages en attente dès que INFO_PUBLISH_INTERVAL est écoulé."""
+    if _info_pending and time.monotonic() - _last_info_pub >= INFO_PUBLISH_INTERVAL:
+        publish_infos()
+
+# Display infos sur TOPIC_FILTER_INFO (au plus une publication par INFO_PUBLISH_INTERVAL)
+# Tout se passe sur le thread principal (callbacks et boucle réseau) : pas de verrou
+def print_mqtt(message):
+    global _info_pending
+    print(message)
+    messages.append(message)
+    _info_pending = True
+    flush_infos_if_due()  # sinon publiés par la boucle réseau à l'échéance
+
 # Callback MQTT
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         print("✅ Connexion au broker réussie.")
         client.publish(TOPIC_FILTER_NEW, "publier ici 1 par 1 les topics pointant sur les valeurs à filtrer")
 
-        # Souscrire aux topics de gestion
-        client.subscribe([
-            (TOPIC_FILTER_NEW, 0),  # Topic de création
-            (TOPIC_FILTER_DELETE, 0),  # Topic de suppression
-            ("simulateur/+/value", 0),  # Topics de valeurs simulées par le script MQTT_Simulateur.py
-        ])
+        # Souscrire aux topics de gestion (et à ceux des filtres, via les jokers)
+        client.subscribe(BASE_SUBSCRIPTIONS)
+
+        # Filtres existants (reconnexion) sur des topics non couverts par les jokers
+        for filter_obj in filters.values():
+            topics = uncovered_topics([filter_obj.source_topic, filter_obj.mode_topic, filter_obj.window_topic])
+            if topics:
+                client.subscribe([(topic, 0) for topic in topics])
 
         # Si aucun filtre n'existe, créer le filtre initial
         # if not filters:
@@ -178,16 +308,22 @@ def on_message(client, userdata, msg):
 
             new_filter = Filter(source_topic, filter_name)
             filters[filter_name] = new_filter
-
-            # S'abonner aux topics de paramètres de ce filtre
-            client.subscribe([(new_filter.mode_topic, 0), (new_filter.window_topic, 0)])
-
-            # S'assurer qu'on est bien abonné au topic source (au cas où ce ne serait pas déjà fait)
-            client.subscribe(source_topic, 0)
+            filters_by_source.setdefault(source_topic, []).append(new_filter)
+            filters_by_param_topic[new_filter.mode_topic] = new_filter
+            filters_by_param_topic[new_filter.window_topic] = new_filter
+
+            # S'abonner aux topics de ce filtre qui ne sont pas déjà couverts par les jokers
+            # (source hors simulateur/X/value, paramètres associés)
+            topics = [new_filter.mode_topic, new_filter.window_topic]
+            if len(filters_by_source[source_topic]) == 1:
+                topics.append(source_topic)  # premier filtre sur ce topic source
+            topics = uncovered_topics(topics)
+            if topics:
+                client.subscribe([(topic, 0) for topic in topics])
 
             # Publier les paramètres initiaux
-            client.publish(new_filter.mode_topic, str(DEFAULT_MODE), qos=0, retain=True)
-            client.publish(new_filter.window_topic, str(DEFAULT_WINDOW_SIZE), qos=0, retain=True)
+            client.publish(new_filter.mode_topic, _DEFAULT_MODE_B, qos=0, retain=True)
+            client.publish(new_filter.window_topic, _DEFAULT_WINDOW_B, qos=0, retain=True)
 
             print_mqtt(f"✅ Nouveau filtre créé: {filter_name} pour {source_topic}")
             print_mqtt(f"   → Topic filtré: {new_filter.filtered_topic}")
@@ -204,11 +340,21 @@ def on_message(client, userdata, msg):
 
             if filter_name in filters:
                 filter_obj = filters[filter_name]
-                # Se désabonner des topics de paramètres
-                client.unsubscribe([filter_obj.mode_topic, filter_obj.window_topic])
                 # Supprimer les topics MQTT
                 filter_obj.delete_topics(client)
                 del filters[filter_name]
+                del filters_by_param_topic[filter_obj.mode_topic]
+                del filters_by_param_topic[filter_obj.window_topic]
+                topics = [filter_obj.mode_topic, filter_obj.window_topic]
+                same_source = filters_by_source[filter_obj.source_topic]
+                same_source.remove(filter_obj)
+                if not same_source:
+                    del filters_by_source[filter_obj.source_topic]
+                    topics.append(filter_obj.source_topic)  # dernier filtre sur ce topic source
+                # Se désabonner des topics qui ne sont pas couverts par les jokers
+                topics = uncovered_topics(topics)
+                if topics:
+                    client.unsubscribe(topics)
                 print_mqtt(f"✅ Filtre supprimé: {filter_name}")
             else:
                 print_mqtt(f"⚠️ Aucun filtre trouvé avec le nom: {filter_name}")
@@ -219,27 +365,33 @@ def on_message(client, userdata, msg):
             return
 
     # Gestion des valeurs entrantes - traiter TOUS les filtres qui correspondent
-    for filter_name, filter_obj in filters.items():
-        if topic == filter_obj.source_topic:
-            try:
-                val = float(msg.payload.decode('utf-8'))
-                filtered_val = filter_obj.process_value(val)
-                client.publish(filter_obj.filtered_topic, f"{filtered_val:.6f}", qos=0)
-                # print(f"[{time.strftime('%H:%M:%S')}] {filter_name}: {filter_obj.source_topic} → {filtered_val:.6f}")
-            except ValueError:
+    # (la valeur n'est décodée qu'une fois pour tous les filtres du topic)
+    same_source = filters_by_source.get(topic)
+    if same_source:
+        try:
+            val = float(msg.payload)
+            if not math.isfinite(val):  # inf / nan : fausseraient la somme glissante
+                raise ValueError(val)
+        except ValueError:
+            if DEBUG:
                 print_mqtt(f"⚠️ Valeur invalide sur {topic}: {msg.payload}")
-            # PAS DE BREAK ici - on continue pour traiter tous les filtres
+        else:
+            for filter_obj in same_source:
+                filtered_val = filter_obj.process_value(val)
+                client.publish(filter_obj.filtered_topic, b"%.6f" % filtered_val, qos=0)
+                # print(f"[{_now_hms()}] {filter_obj.filter_name}: {filter_obj.source_topic} → {filtered_val:.6f}")
+                # PAS DE BREAK ici - on continue pour traiter tous les filtres
 
     # Gestion des paramètres (mode et fenêtre)
-    filter_obj = find_filter_by_param_topic(topic)
+    filter_obj = filters_by_param_topic.get(topic)
     if filter_obj:
         if topic == filter_obj.mode_topic:
             try:
-                val = int(msg.payload.decode('utf-8'))
+                val = int(msg.payload)
                 if 1 <= val <= 4:
-                    filter_obj.mode = val
+                    filter_obj.update_mode(val)
                     mode_name = mode_names[val]
-                    print_mqtt(f"[{time.strftime('%H:%M:%S')}] {filter_obj.filter_name} → Mode changé: {mode_name}")
+                    print_mqtt(f"[{_now_hms()}] {filter_obj.filter_name} → Mode changé: {mode_name}")
                 else:
                     print_mqtt(f"⚠️ Mode invalide (doit être 1 ou 4): {val}")
             except ValueError:
@@ -247,10 +399,10 @@ def on_message(client, userdata, msg):
 
         elif topic == filter_obj.window_topic:
             try:
-                val = int(msg.payload.decode('utf-8'))
+                val = int(msg.payload)
                 if val > 0:
                     filter_obj.update_window_size(val)
-                    print_mqtt(f"[{time.strftime('%H:%M:%S')}] {filter_obj.filter_name} → Taille fenêtre: {val}")
+                    print_mqtt(f"[{_now_hms()}] {filter_obj.filter_name} → Taille fenêtre: {val}")
                 else:
                     print_mqtt("⚠️ La taille de la fenêtre doit être positive")
             except ValueError:
@@ -268,8 +420,6 @@ except Exception as e:
     print(f"❌ Impossible de se connecter à {BROKER_HOST}:{BROKER_PORT} → {e}")
     sys.exit(1)
 
-client.loop_start()
-
 print("\n▶️  Système de filtrage multiple en cours – appuyez sur Ctrl‑C pour arrêter.")
 print(f"   Filtre initial créé pour {INITIAL_FILTER_TOPIC}")
 print("\n📋 Utilisation:")
@@ -299,8 +449,25 @@ def show_active_filters():
             print(f"     Mode ({filter_obj.mode}): {mode_str}, Fenêtre: {filter_obj.window_size}")
 
 # Afficher l'état initial
-time.sleep(2)  # Laisser le temps au filtre initial de se créer
 show_active_filters()
 
-while True:
-    time.sleep(1)
\ No newline at end of file
+# Boucle réseau sur le thread principal (les callbacks y sont exécutés directement) :
+# entre deux passes, publication des infos en attente ; reconnexion après une coupure
+def network_loop():
+    # Attentes toujours bornées (select, _stop.wait) : Ctrl-C est pris en compte
+    # même sous Windows, où une attente sans délai n'est pas interrompue
+    while not _stop.is_set():
+        if client.loop(timeout=INFO_PUBLISH_INTERVAL) == mqtt.MQTT_ERR_SUCCESS:
+            flush_infos_if_due()
+            continue
+        if _stop.wait(RECONNECT_DELAY):
+            break
+        try:
+            client.reconnect()
+        except OSError as e:
+            print(f"⚠️ Reconnexion impossible ({e}) – nouvel essai dans {RECONNECT_DELAY} s")
+
+try:
+    network_loop()
+except KeyboardInterrupt:
+    graceful_shutdown()
\ No newline at end of file
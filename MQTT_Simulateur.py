@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import heapq
 import json
 import math
+import re
+import threading
 import time
-import random
 from collections import deque
 
+import numpy as np
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
 # --------------------------------------------------------------------------- #
 # Configuration du broker MQTT
@@ -15,6 +20,12 @@ import paho.mqtt.client as mqtt
 
 BROKER_HOST = "localhost"
 BROKER_PORT = 1883
+# mqtt.MQTTv5 : alias de topics pour les valeurs publiées (broker MQTT 5 requis, ex. mosquitto ≥ 1.6)
+MQTT_PROTOCOL = mqtt.MQTTv311
+
+# Attente maximale (s) de main_loop : sous Windows, une attente sans délai n'est pas
+# interrompue par Ctrl-C
+MAX_WAIT = 1.0
 
 TOPIC_NEW = "simulateur/new"
 TOPIC_DELETE = "simulateur/delete"
@@ -26,6 +37,34 @@ TOPIC_PARAM_MIN = "simulateur/{}/parameters/min"
 TOPIC_PARAM_MAX = "simulateur/{}/parameters/max"
 TOPIC_PARAM_NOISE = "simulateur/{}/parameters/noise"
 TOPIC_PARAM_PERIOD_PUBLISH = "simulateur/{}/parameters/period_publish"
+# Reconnaissance d'un topic de paramètre : groupe 1 = nom de la variable, groupe 2 = paramètre
+_PARAM_RE = re.compile(r'^simulateur/([^/]+)/parameters/(period|min|max|noise|period_publish)$')
+
+TAU = 2.0 * math.pi
+
+# Table de sinus précalculée (précision largement suffisante pour la simulation)
+SIN_LUT_BITS = 12
+SIN_LUT_SIZE = 1 << SIN_LUT_BITS
+_SIN_LUT = [math.sin(TAU * i / SIN_LUT_SIZE) for i in range(SIN_LUT_SIZE)]
+
+# Phase entière sur 32 bits : 2^32 ↔ 2π, le modulo est un simple masque
+# et les bits de poids fort donnent directement l'indice dans la table
+PHASE_BITS = 32
+PHASE_MASK = (1 << PHASE_BITS) - 1
+_PHASE_TO_LUT = PHASE_BITS - SIN_LUT_BITS
+
+# Bruit gaussien : tirages N(0, 1) faits par lots avec numpy (PCG64)
+NOISE_BATCH_SIZE = 4096
+_rng = np.random.default_rng()
+_noise_batch = []
+
+
+def _standard_normal():
+    """Tirage N(0, 1) pris dans le lot courant (renouvelé quand il est épuisé)."""
+    global _noise_batch
+    if not _noise_batch:
+        _noise_batch = _rng.standard_normal(NOISE_BATCH_SIZE).tolist()
+    return _noise_batch.pop()
 
 # --------------------------------------------------------------------------- #
 # README – documentation « live » envoyée au broker lors de la connexion
@@ -61,6 +100,11 @@ Pour supprimer une variable, publiez son nom sur le topic **simulateur/delete**.
 }"""
 
 
+def _is_valid_period(value):
+    """Période utilisable par l'échéancier : finie et strictement positive."""
+    return math.isfinite(value) and value > 0
+
+
 # --------------------------------------------------------------------------- #
 # Classe représentant une variable simulée
 # --------------------------------------------------------------------------- #
@@ -68,6 +112,10 @@ Pour supprimer une variable, publiez son nom sur le topic **simulateur/delete**.
 class SimVar:
     """Variable simulée qui génère une sinusoïde + bruit gaussien."""
 
+    __slots__ = ('name', 'period', 'min', 'max', 'noise_stddev', 'period_publish',
+                 '_amplitude', '_mid_point', '_dphase_i', '_phase_i', '_next_time',
+                 '_value_topic', '_param_topics', '_all_topics', '_published')
+
     def __init__(self, name, period=60.0,
                  min_val=15.0, max_val=61.0,
                  noise_stddev=5.0,
@@ -78,89 +126,103 @@ class SimVar:
         self.max = float(max_val)
         self.noise_stddev = float(noise_stddev)
         self.period_publish = float(period_publish)
+        if not (_is_valid_period(self.period) and _is_valid_period(self.period_publish)):
+            raise ValueError("period et period_publish doivent être finis et strictement positifs")
+        self._update_sinusoid()
+        self._update_phase_step()
+        self._value_topic = f"simulateur/{name}/value"
+        # Topics des paramètres, dans l'ordre period, min, max, noise, period_publish
+        self._param_topics = {
+            'period': TOPIC_PARAM_PERIOD.format(name),
+            'min': TOPIC_PARAM_MIN.format(name),
+            'max': TOPIC_PARAM_MAX.format(name),
+            'noise': TOPIC_PARAM_NOISE.format(name),
+            'period_publish': TOPIC_PARAM_PERIOD_PUBLISH.format(name),
+        }
+        self._all_topics = tuple(self._param_topics.values()) + (self._value_topic,)
+        self._published = {}  # topic → dernière valeur retenue par le broker
 
-        self._phase = 0.0
-        self._next_time = time.time()
-        self.queue = deque()
+        self._phase_i = 0
+        self._next_time = time.monotonic()
 
-    def _sinusoid_value(self):
-        """Valeur sinusoïdale brute (entre min et max)."""
-        amplitude = (self.max - self.min) / 2.0
-        mid_point = (self.max + self.min) / 2.0
-        return mid_point + amplitude * math.sin(self._phase)
+    def _update_sinusoid(self):
+        """Précalcule amplitude et point milieu (à refaire quand min ou max change)."""
+        self._amplitude = (self.max - self.min) / 2.0
+        self._mid_point = (self.max + self.min) / 2.0
 
-    def _apply_noise(self, val):
-        """Ajoute un bruit gaussien."""
-        if self.noise_stddev == 0:
-            return val
-        return val + random.gauss(0, self.noise_stddev)
+    def _update_phase_step(self):
+        """Précalcule l'incrément de phase entière par publication : 2^32 * Δt / période."""
+        self._dphase_i = round((1 << PHASE_BITS) * self.period_publish / self.period) & PHASE_MASK
 
     def publish_params(self, client: mqtt.Client):
-        """Publie chaque paramètre sur son propre topic."""
-        params = {
-            TOPIC_PARAM_PERIOD.format(self.name): str(self.period),
-            TOPIC_PARAM_MIN.format(self.name): str(self.min),
-            TOPIC_PARAM_MAX.format(self.name): str(self.max),
-            TOPIC_PARAM_NOISE.format(self.name): str(self.noise_stddev),
-            TOPIC_PARAM_PERIOD_PUBLISH.format(self.name): str(self.period_publish)
-        }
-        for topic, value in params.items():
-            client.publish(topic, payload=value, qos=1, retain=True)
+        """Publie chaque paramètre sur son propre topic (seulement ceux qui ont changé)."""
+        values = (self.period, self.min, self.max, self.noise_stddev, self.period_publish)
+        for topic, value in zip(self._param_topics.values(), values):
+            payload = str(value)
+            if self._published.get(topic) != payload:
+                client.publish(topic, payload=payload, qos=1, retain=True)
+                self._published[topic] = payload
 
     def delete_params(self, client: mqtt.Client):  # NOUVEAU: Méthode pour supprimer
         """Supprime tous les paramètres en publiant des chaînes vides."""
-        topics = [
-            TOPIC_PARAM_PERIOD.format(self.name),
-            TOPIC_PARAM_MIN.format(self.name),
-            TOPIC_PARAM_MAX.format(self.name),
-            TOPIC_PARAM_NOISE.format(self.name),
-            TOPIC_PARAM_PERIOD_PUBLISH.format(self.name),
-            f"simulateur/{self.name}/value"
-        ]
-        for topic in topics:
+        for topic in self._all_topics:
             client.publish(topic, payload="", qos=1, retain=True)
+        self._published.clear()
 
     def update_param(self, param_name: str, value: float):
         """Met à jour un paramètre spécifique."""
+        # Validation avant toute affectation : une période nulle, négative, infinie ou NaN
+        # bloquerait l'échéancier de main_loop
+        if param_name in ('period', 'period_publish') and not _is_valid_period(value):
+            # Le broker a retenu la valeur refusée : le cache ne correspond plus, le prochain
+            # publish_params republiera la valeur courante
+            self._published.pop(self._param_topics[param_name], None)
+            raise ValueError(f"{param_name} doit être fini et strictement positif")
         if param_name == 'period':
             self.period = float(value)
+            self._update_phase_step()
         elif param_name == 'min':
             self.min = float(value)
+            self._update_sinusoid()
         elif param_name == 'max':
             self.max = float(value)
+            self._update_sinusoid()
         elif param_name == 'noise':
             self.noise_stddev = float(value)
         elif param_name == 'period_publish':
             self.period_publish = float(value)
-
-    def publish_pending(self, client: mqtt.Client):
-        """Publie les messages qui sont arrivés depuis le dernier appel."""
-        while self.queue:
-            payload = self.queue.popleft()
-            topic = f"simulateur/{self.name}/value"
-            client.publish(topic, payload=payload, qos=0)
+            self._update_phase_step()
+        else:
+            return
+        # Valeur reçue sur le topic du paramètre : c'est celle que retient le broker
+        self._published[self._param_topics[param_name]] = str(float(value))
 
     def step(self, now: float):
         """
         Gère la génération de valeurs et l'envoi à intervalles réguliers.
-        Doit être appelé en boucle principale (ex. 10 ms).
+        Appelé par la boucle principale quand la prochaine échéance est atteinte.
         """
         if now >= self._next_time:
-            # ---- Génération d'une nouvelle valeur ----
-            base_val = self._sinusoid_value()
-            value = self._apply_noise(base_val)
+            # Chemin critique (appelé period_publish⁻¹ fois par seconde et par variable) :
+            # attributs lus une seule fois, pas d'appel de méthode intermédiaire
+            phase_i = self._phase_i
+
+            # ---- Génération d'une nouvelle valeur : sinusoïde (entre min et max) + bruit ----
+            value = self._mid_point + self._amplitude * _SIN_LUT[phase_i >> _PHASE_TO_LUT]
+            noise_stddev = self.noise_stddev
+            if noise_stddev != 0:
+                value += noise_stddev * _standard_normal()
 
             # On empile le message à publier
-            self.queue.append(f"{value:.4f}")
+            OUTBOX.append((self._value_topic, b"%.4f" % value))
 
-            # Mise à jour pour l'intervalle suivant
-            self._next_time += self.period_publish
+            # Mise à jour pour l'intervalle suivant ; en retard d'une période ou plus,
+            # les échéances manquées sont abandonnées plutôt que rattrapées en rafale
+            next_time = self._next_time + self.period_publish
+            self._next_time = next_time if next_time > now else now + self.period_publish
 
-            # Incrémenter la phase (en radians) : 2π * Δt / période
-            delta_t = self.period_publish
-            self._phase += 2.0 * math.pi * delta_t / self.period
-            if self._phase > 2.0 * math.pi:
-                self._phase -= 2.0 * math.pi
+            # Incrémenter la phase, ramenée dans [0, 2^32) par le masque (pas de dérive flottante)
+            self._phase_i = (phase_i + self._dphase_i) & PHASE_MASK
 
 
 # --------------------------------------------------------------------------- #
@@ -168,15 +230,34 @@ class SimVar:
 # --------------------------------------------------------------------------- #
 
 simvars = {}  # dictionnaire name → SimVar
+simvars_version = 0  # incrémenté à chaque ajout/suppression dans simvars
+simvars_changed = threading.Event()  # réveille main_loop après un ajout/suppression
+OUTBOX = deque(maxlen=65536)  # (topic, payload) en attente de publication, toutes variables confondues
+OUTBOX_FLUSH_SIZE = 256  # publication sans attendre une pause de l'échéancier au-delà de ce nombre
+
+# Alias de topics MQTT 5 : valables uniquement pour la connexion en cours
+topic_aliases = {}  # topic → Properties(TopicAlias) déjà annoncé au broker
+topic_alias_max = 0  # nombre d'alias acceptés par le broker (TopicAliasMaximum du CONNACK)
+topic_aliases_lock = threading.Lock()  # callbacks réseau (on_connect / on_disconnect) vs publish_outbox
 
 
 # --------------------------------------------------------------------------- #
 # Callbacks MQTT
 # --------------------------------------------------------------------------- #
 
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties=None):
+    global topic_alias_max
     if rc == 0:
         print("✅ Connecté au broker")
+        # Nouvelle connexion : aucun alias annoncé, limite fixée par le broker (0 → pas d'alias)
+        with topic_aliases_lock:
+            topic_aliases.clear()
+            topic_alias_max = getattr(properties, 'TopicAliasMaximum', 0)
+
+        # Le broker a pu perdre ses messages retenus : tout republier
+        for sv in simvars.values():
+            sv._published.clear()
+
         # Publication du README
         client.publish(TOPIC_README,
                        payload=SIMULATOR_README_TEXT.strip(),
@@ -205,7 +286,16 @@ def on_connect(client, userdata, flags, rc):
         print(f"❌ Connexion échouée (code {rc})")
 
 
+def on_disconnect(client, userdata, rc, properties=None):
+    global topic_alias_max
+    # Les alias sont perdus avec la connexion : topics complets jusqu'au prochain CONNACK
+    with topic_aliases_lock:
+        topic_aliases.clear()
+        topic_alias_max = 0
+
+
 def on_message(client, userdata, msg):
+    global simvars_version
     try:
         # Gestion des nouvelles variables simulées
         if msg.topic == TOPIC_NEW:
@@ -219,7 +309,13 @@ def on_message(client, userdata, msg):
                 noise_stddev=float(payload.get("noise", 5.0)),
                 period_publish=float(payload.get("period_publish", 0.5))
             )
+            previous = simvars.get(name)
+            if previous is not None:
+                # Variable recréée : ne republier que les paramètres qui ont changé
+                sv._published = previous._published
             simvars[name] = sv
+            simvars_version += 1
+            simvars_changed.set()
             sv.publish_params(client)
             print(f"✅ Variable '{name}' créée avec les paramètres spécifiés")
             return
@@ -230,16 +326,17 @@ def on_message(client, userdata, msg):
             if name in simvars:
                 simvars[name].delete_params(client)
                 del simvars[name]
+                simvars_version += 1
+                simvars_changed.set()
                 print(f"✅ Variable '{name}' supprimée")
             else:
                 print(f"⚠️ Variable '{name}' non trouvée")
             return
 
         # Gestion des modifications de paramètres
-        parts = msg.topic.split('/')
-        if len(parts) == 4 and parts[0] == 'simulateur' and parts[2] == 'parameters':
-            name = parts[1]
-            param = parts[3]
+        match = _PARAM_RE.match(msg.topic)
+        if match:
+            name, param = match.group(1), match.group(2)
             if name in simvars:
                 try:
                     value = float(msg.payload.decode())
@@ -256,14 +353,69 @@ def on_message(client, userdata, msg):
 # Boucle principale : publication et gestion des variables
 # --------------------------------------------------------------------------- #
 
+def publish_outbox(client: mqtt.Client):
+    """Publie d'un bloc tous les messages en attente dans OUTBOX.
+
+    En MQTT 5, chaque topic de valeur reçoit un alias (dans la limite annoncée par le broker) :
+    le topic complet n'est transmis qu'à la première publication, ensuite seulement l'alias.
+    """
+    publish = client.publish
+    if not topic_alias_max:
+        # Pas d'alias (MQTT 3.1.1 ou broker qui les refuse) : ni verrou ni recherche par topic
+        while OUTBOX:
+            topic, payload = OUTBOX.popleft()
+            publish(topic, payload, qos=0)
+        return
+
+    with topic_aliases_lock:
+        while OUTBOX:
+            topic, payload = OUTBOX.popleft()
+            alias = topic_aliases.get(topic)
+            if alias is not None:
+                publish("", payload, qos=0, properties=alias)
+            elif len(topic_aliases) < topic_alias_max:
+                alias = Properties(PacketTypes.PUBLISH)
+                alias.TopicAlias = len(topic_aliases) + 1
+                # Alias retenu seulement si paho a accepté le paquet qui l'annonce (mis en file
+                # pour la connexion courante) ; une coupure ensuite vide la table (on_disconnect)
+                if publish(topic, payload, qos=0, properties=alias).rc == mqtt.MQTT_ERR_SUCCESS:
+                    topic_aliases[topic] = alias
+            else:
+                publish(topic, payload, qos=0)
+
+
 def main_loop(client: mqtt.Client):
+    snapshot_version = -1
+    schedule = []  # tas (prochaine échéance, n°, SimVar) : la plus proche en tête
     try:
         while True:
-            now = time.time()
-            for sv in list(simvars.values()):
-                sv.step(now)
-                sv.publish_pending(client)
-            time.sleep(0.01)
+            # Échéancier reconstruit seulement si simvars a changé
+            if snapshot_version != simvars_version:
+                snapshot_version = simvars_version
+                # Copie en une fois : simvars est modifié par on_message (thread réseau)
+                schedule = [(sv._next_time, i, sv) for i, sv in enumerate(list(simvars.values()))]
+                heapq.heapify(schedule)
+
+            if not schedule:
+                publish_outbox(client)
+                if simvars_changed.wait(MAX_WAIT):
+                    simvars_changed.clear()
+                continue
+
+            # Attente jusqu'à la prochaine échéance (ou jusqu'à un ajout/suppression)
+            next_time, i, sv = schedule[0]
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                # Tout ce qui est dû a été généré : publication avant de dormir
+                publish_outbox(client)
+                if simvars_changed.wait(min(delay, MAX_WAIT)):
+                    simvars_changed.clear()
+                continue
+
+            sv.step(time.monotonic())
+            heapq.heapreplace(schedule, (sv._next_time, i, sv))
+            if len(OUTBOX) >= OUTBOX_FLUSH_SIZE:
+                publish_outbox(client)  # échéancier saturé : pas de pause avant longtemps
     except KeyboardInterrupt:
         print("\n🛑 Arrêt du simulateur")
         client.disconnect()
@@ -273,8 +425,9 @@ def main_loop(client: mqtt.Client):
 # Construction du client MQTT + lancement
 # --------------------------------------------------------------------------- #
 
-client = mqtt.Client()
+client = mqtt.Client(protocol=MQTT_PROTOCOL)
 client.on_connect = on_connect
+client.on_disconnect = on_disconnect
 client.on_message = on_message
 
 client.connect(BROKER_HOST, BROKER_PORT, keepalive=60)
@@ -2,9 +2,14 @@ import cv2
 import numpy as np
 import paho.mqtt.client as mqtt
 import time
-import base64
-from io import BytesIO
-from PIL import Image
+import json
+
+# Décodage JPEG accéléré (libjpeg-turbo, SIMD) si PyTurboJPEG est disponible, sinon cv2.imdecode
+try:
+    from turbojpeg import TurboJPEG, TJPF_GRAY
+    turbo_jpeg = TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    turbo_jpeg = None
 
 # Configuration
 MQTT_BROKER = "localhost"  # Adresse de votre broker MQTT
@@ -12,26 +17,43 @@ MQTT_PORT = 1883
 TOPIC_IMAGE = "portik/image"
 TOPIC_VITESSE = "portik/vitesse"
 TOPIC_VITESSE_FULL = "portik/vitesse_json"
+PUBLIER_JSON = False  # True : publier aussi le détail de la mesure (JSON) sur TOPIC_VITESSE_FULL
 
 # Paramètres de traitement
 CROP_LEFT = 160
 CROP_RIGHT = 250
 CROP_TOP = 20
 CROP_BOTTOM = 35
-#TOLERANCE = 0.80  # 80% de similarité
+TOLERANCE = 0.80  # 80% de similarité (méthode "template")
 ZONE_RECHERCHE = 0.25  # 25% premières lignes
+MARGE_RECHERCHE = 20  # variation max (pixels) du déplacement d'une image à la suivante
+CONFIANCE_BANDE = 0.80  # en dessous, la recherche dans la bande est refaite sur toute l'image
+METHODE_DEPLACEMENT = "template"  # "template" : cv2.matchTemplate ; "phase" : cv2.phaseCorrelate (sous-pixel)
 PIXELS_TO_MM = (680/500 + 862/500) / 2  # Conversion pixels vers mm (à ajuster selon votre caméra)
 
 # Variables globales
 crop_prec = None
 time_prec = None
+last_match_row = None  # ligne où le template a été trouvé dans l'image précédente
+hanning_window = None  # fenêtre de Hanning (méthode "phase"), recréée si la taille du crop change
+crop_shape = None  # taille de l'image pour laquelle crop_slices a été calculé
+crop_slices = None  # (lignes, colonnes) du crop, recalculées seulement si la taille de l'image change
 
 first_cropped_is_saved = False
 
 def crop_image(image):
-    global CROP_TOP, CROP_BOTTOM, CROP_LEFT, CROP_RIGHT
-    h, w = image.shape[:2]
-    return image[CROP_TOP:h - CROP_BOTTOM, CROP_LEFT:w - CROP_RIGHT]
+    global crop_shape, crop_slices
+    if image.shape != crop_shape:
+        h, w = image.shape[:2]
+        crop_shape = image.shape
+        crop_slices = (slice(CROP_TOP, h - CROP_BOTTOM), slice(CROP_LEFT, w - CROP_RIGHT))
+    return image[crop_slices]
+
+def decode_gray(img_data):
+    """Décode l'image directement en niveaux de gris (None si le décodage échoue)"""
+    if turbo_jpeg is not None and img_data[:2] == b'\xff\xd8':  # marqueur SOI d'un JPEG
+        return turbo_jpeg.decode(img_data, pixel_format=TJPF_GRAY)[:, :, 0]
+    return cv2.imdecode(np.frombuffer(img_data, np.uint8), cv2.IMREAD_GRAYSCALE)
 
 def calculate_displacement(crop_current, crop_previous):
     """Calcule le déplacement vertical entre deux images"""
@@ -42,21 +64,54 @@ def calculate_displacement(crop_current, crop_previous):
     zone_height = int(h * ZONE_RECHERCHE)
     template = crop_previous[offset:zone_height + offset, :]
 
-    # Recherche de correspondance par template matching
-    result = cv2.matchTemplate(crop_current, template, cv2.TM_CCOEFF_NORMED)
-    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
-
-    displacement = max_loc[1] - offset
-    return displacement, max_val
+    global last_match_row
+    match_row = None
+
+    # Recherche de correspondance par template matching, d'abord dans une bande verticale
+    # autour de la position trouvée pour l'image précédente
+    if last_match_row is not None:
+        start = max(0, last_match_row - MARGE_RECHERCHE)
+        stop = min(crop_current.shape[0], last_match_row + zone_height + MARGE_RECHERCHE)
+        result = cv2.matchTemplate(crop_current[start:stop, :], template, cv2.TM_CCOEFF_NORMED)
+        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
+
+        # Pic sur un bord intérieur de la bande ou correspondance médiocre :
+        # le vrai maximum est peut-être en dehors de la bande
+        on_edge = (max_loc[1] == 0 and start > 0) or \
+                  (max_loc[1] == result.shape[0] - 1 and stop < crop_current.shape[0])
+        if not on_edge and max_val >= CONFIANCE_BANDE:
+            match_row = start + max_loc[1]
+
+    # Première image ou déplacement hors de la bande : recherche sur toute l'image
+    if match_row is None:
+        result = cv2.matchTemplate(crop_current, template, cv2.TM_CCOEFF_NORMED)
+        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
+        match_row = max_loc[1]
 
     # Vérification du seuil de tolérance
-    if max_val >= TOLERANCE:
-        # Déplacement vertical (positif = vers le bas)
-        displacement = max_loc[1]
-        return displacement, max_val
-    else:
+    if max_val < TOLERANCE:
+        last_match_row = None  # position non fiable : recherche complète à l'image suivante
         return None, max_val
 
+    # Déplacement vertical (positif = vers le bas)
+    last_match_row = match_row
+    displacement = match_row - offset
+    return displacement, max_val
+
+def calculate_displacement_phase(crop_current, crop_previous):
+    """Calcule le déplacement vertical (sous-pixel) entre deux images par corrélation de phase.
+
+    Deux FFT au lieu d'un balayage du template ; le déplacement mesurable est limité à
+    la moitié de la hauteur du crop.
+    """
+    global hanning_window
+    h, w = crop_previous.shape[:2]
+    if hanning_window is None or hanning_window.shape != (h, w):
+        hanning_window = cv2.createHanningWindow((w, h), cv2.CV_32F)
+
+    (dx, dy), response = cv2.phaseCorrelate(np.float32(crop_previous), np.float32(crop_current), hanning_window)
+    return dy, response
+
 
 def on_message(client, userdata, msg):
     """Callback appelé à la réception d'une image"""
@@ -65,28 +120,26 @@ def on_message(client, userdata, msg):
     time_current = time.time()
 
     try:
-        # Décodage de l'image
-        img_data = msg.payload
-        nparr = np.frombuffer(img_data, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        # Décodage de l'image, directement en niveaux de gris (seuls ceux-ci sont utilisés)
+        image = decode_gray(msg.payload)
 
         if image is None:
             print("Erreur: impossible de décoder l'image")
             return
 
         # 1) Cropper l'image
-        crop = crop_image(image)
+        crop_gray = crop_image(image)
 
         if not first_cropped_is_saved:
             first_cropped_is_saved = True
-            cv2.imwrite("first_cropped.jpg", crop)
-
-        # Convertir en niveaux de gris pour le traitement
-        crop_gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+            cv2.imwrite("first_cropped.jpg", crop_gray)
 
         # 2) Comparer avec l'image précédente (sauf première fois)
         if crop_prec is not None and time_prec is not None:
-            displacement, confidence = calculate_displacement(crop_gray, crop_prec)
+            if METHODE_DEPLACEMENT == "phase":
+                displacement, confidence = calculate_displacement_phase(crop_gray, crop_prec)
+            else:
+                displacement, confidence = calculate_displacement(crop_gray, crop_prec)
 
             if displacement is not None:
                 # Calcul du temps écoulé
@@ -100,22 +153,24 @@ def on_message(client, userdata, msg):
                 vitesse_m_s = vitesse_mm_s / 1000.0
 
                 # Publication sur MQTT
-                vitesse_data = {
-                    "vitesse_m_s": round(vitesse_m_s, 3),
-                    "vitesse_pixels_s": round(vitesse_pixels, 2),
-                    "deplacement_pixels": displacement,
-                    "delta_temps_ms": round(delta_time * 1000, 1),
-                    "confiance": round(confidence, 2)
-                }
-
-                client.publish(TOPIC_VITESSE, str(vitesse_m_s))
-                #client.publish(TOPIC_VITESSE_FULL, str(vitesse_data))
-                print(f"Vitesse: {vitesse_m_s:.3f} m/s (déplacement: {displacement}px, confiance: {confidence:.2f})")
+                client.publish(TOPIC_VITESSE, b"%.3f" % vitesse_m_s)
+
+                if PUBLIER_JSON:
+                    vitesse_data = {
+                        "vitesse_m_s": round(vitesse_m_s, 3),
+                        "vitesse_pixels_s": round(vitesse_pixels, 2),
+                        "deplacement_pixels": displacement,
+                        "delta_temps_ms": round(delta_time * 1000, 1),
+                        "confiance": round(confidence, 2)
+                    }
+                    client.publish(TOPIC_VITESSE_FULL, json.dumps(vitesse_data))
+                print(f"Vitesse: {vitesse_m_s:.3f} m/s (déplacement: {displacement:g}px, confiance: {confidence:.2f})")
             # else:
             #     print(f"Pas de correspondance trouvée (confiance: {confidence:.2f} < {TOLERANCE})")
 
-        # 3) Mise à jour de l'image précédente
-        crop_prec = crop_gray.copy()
+        # 3) Mise à jour de l'image précédente (pas de copie : chaque image est
+        # décodée dans un nouveau buffer qui n'est plus modifié ensuite)
+        crop_prec = crop_gray
         time_prec = time_current
 
     except Exception as e: